@@ -1,69 +1,279 @@
 import discord
 import os
-import json
-import tempfile
-import base64
+import re
 from discord import app_commands
 from discord.ext import commands, tasks
-from flask import Flask
-from threading import Thread # スレッド処理のために必須
-from multiprocessing import current_process
+from aiohttp import web # discord.pyの依存ライブラリ。ヘルスチェック用のWebサーバーとして使用
 from datetime import datetime, timedelta, timezone, time 
 import asyncio
+import functools
 import logging 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+from time import monotonic
 
-# ログ設定: BotのカスタムメッセージとDiscordの詳細な接続情報を表示できるように設定
-# レベルをINFOからDEBUGに引き上げ、より詳細な情報（Bot内部の処理やDiscord通信）を表示
+# ログ設定: 通常はINFOレベルで出力し、環境変数 LOG_LEVEL=DEBUG の場合のみBot内部の処理の詳細な情報も表示する
+# (DEBUGではプレゼンス更新のたびにログが出力されるため、本番環境では有効にしない)
 logging.basicConfig(
-    level=logging.DEBUG, # デバッグレベルに変更
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s %(levelname)s %(name)s: %(message)s'
 )
-# Discordライブラリ自体のロガーをデバッグレベルに設定
+# Discordライブラリ自体のロガーは通常INFOレベルとし、環境変数 DISCORD_DEBUG=1 の場合のみデバッグレベルにする
+# (DEBUGではハートビートやGatewayのイベント、HTTP通信がすべて出力され、プレゼンス更新が多いと負荷になる)
 discord_logger = logging.getLogger('discord')
-discord_logger.setLevel(logging.DEBUG) 
+discord_logger.setLevel(logging.DEBUG if os.getenv("DISCORD_DEBUG") == "1" else logging.INFO)
 
 
 # Firebase/Firestore関連のインポート
 try:
     import firebase_admin
     from firebase_admin import credentials, firestore
+    from google.cloud.firestore_v1.field_path import FieldPath
 except ImportError:
     logging.warning("警告: 'firebase-admin'ライブラリが見つかりません。Botを実行するにはインストールが必要です。")
 
+# JSONのパースにはorjsonを使用 (未インストールの場合は標準ライブラリのjsonで代替)
+# NOTE: discord.pyもorjsonがインストールされていればGatewayのペイロード解析に自動で使用する
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    logging.info("ℹ️ 'orjson'ライブラリが見つからないため、標準のjsonモジュールを使用します。")
+    import json
+    json_loads = json.loads
+
+# イベントループにはuvloopを使用 (未インストールの場合やWindowsではasyncioの標準のイベントループで動作する)
+try:
+    import uvloop
+except ImportError:
+    logging.info("ℹ️ 'uvloop'ライブラリが見つからないため、asyncioの標準のイベントループを使用します。")
+    uvloop = None
+
 
-# Flaskのアプリケーションインスタンスを作成（Webサーバーとして機能）
-app = Flask(__name__)
+# ヘルスチェック用Webサーバーのルート定義 (アプリケーションはファイル末尾で作成し、Botと同じイベントループで動かす)
+routes = web.RouteTableDef()
 
 # Firestore接続とBotの状態管理のためのグローバル変数
 db = None
-# 直前のユーザーのステータスと、その状態に移行した時刻 (ユーザーID -> (ステータスキー, datetimeオブジェクト))
-last_status_updates = {} 
 tz_jst = timezone(timedelta(hours=9)) # 日本時間 (JST)
-# Botスレッドの状態管理用グローバル変数
-bot_thread = None
-# Botの準備完了状態を示すフラグ (Discordへの接続が完了したか)
-bot_ready_status = False # 新しいグローバル変数
+# Botを実行しているタスク (Webサーバーの起動時に作成される)
+bot_task = None
+# Firestoreのblocking I/O専用のスレッドプール (同時実行数を制限し、負荷が集中してもスレッドが増え続けないようにする)
+firestore_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fs')
+# ステータス時間の書き込みバッファをFirestoreへフラッシュする間隔 (秒、環境変数で変更可能)
+FLUSH_INTERVAL_SECONDS = float(os.getenv("FLUSH_INTERVAL_SECONDS", "5"))
+# 書き込み待ちのユーザー数がこの数に達したら、間隔を待たずにフラッシュする
+FLUSH_THRESHOLD_USERS = 400
+# これより短いステータスは記録せず、次のステータスの時間として扱う (秒、環境変数で変更可能)
+MIN_WRITE_SECONDS = float(os.getenv("MIN_WRITE_SECONDS", "2.0"))
+# 1回のWriteBatchに含められる書き込み数の上限 (Firestoreの制限は500)
+FIRESTORE_BATCH_LIMIT = 500
+# 1回のget_allで取得するドキュメント数 (日次レポートでは、これを超える分を分割して並行に取得する)
+GET_ALL_CHUNK_SIZE = 300
+# ユーザードキュメント配下の日別集計サブコレクション名 (ドキュメントIDは YYYY-MM-DD)
+DAILY_SUBCOLLECTION = 'daily'
+# 日別集計サブコレクション導入前にユーザードキュメントへ直接書き込んでいた日別フィールド ('YYYY-MM-DD_<status>_seconds')
+LEGACY_DAILY_FIELD = re.compile(r'^(\d{4}-\d{2}-\d{2})_(\w+)_seconds$')
+# 日別集計ドキュメントの保持日数 (これより古いものは定期タスクで削除)
+DAILY_ROLLUP_RETENTION_DAYS = 400
+# 日次レポートの実行時刻 (JST)。日付が変わる直前のステータス時間がフラッシュされるよう、0時ちょうどから少し遅らせる
+DAILY_REPORT_TIME = time(0, 5, tzinfo=tz_jst)
+# ログやコマンドの応答に表示する日次レポートの実行時刻 ('HH:MM')
+DAILY_REPORT_TIME_TEXT = DAILY_REPORT_TIME.strftime("%H:%M")
+# 日次レポートで1メッセージにまとめて送信する埋め込みの数 (Discordの上限は10)
+EMBEDS_PER_MESSAGE = 10
+# 日次レポートの送信レート (Discordのチャンネルごとのレートリミット: 5秒あたり5メッセージ)
+DAILY_REPORT_SEND_RATE = 5
+DAILY_REPORT_SEND_PER_SECONDS = 5.0
+
+# ステータスの内部コード (インデックスがコード)。'invisible' は 'offline' として扱う
+STATUS_NAMES = ('online', 'idle', 'dnd', 'offline')
+# オンライン活動時間として集計するステータス
+ONLINE_STATUSES = frozenset(('online', 'idle', 'dnd'))
+STATUS_CODES = {'online': 0, 'idle': 1, 'dnd': 2, 'offline': 3, 'invisible': 3}
+OFFLINE_CODE = STATUS_CODES['offline']
+# レポートで日別集計ドキュメントから読み出すフィールド (get_allのfield_pathsで指定し、不要なフィールドを転送しない)
+ROLLUP_FIELD_PATHS = list(STATUS_NAMES)
+# ステータス名に対応する絵文字と表示名 (ステータスは閉じた集合のため辞書で引く)
+STATUS_EMOJI = {
+    'online': '🟢 オンライン',
+    'idle': '🌙 退席中',
+    'dnd': '🔴 取り込み中',
+    'offline': '⚫ オフライン',
+    'invisible': '⚫ オフライン',
+}
+# JSTの 'YYYY-MM-DD' 形式の日付文字列のキャッシュ
+# start/endはその日の0時と翌日0時の単調増加時計の値で、範囲外になった時のみ壁時計から再計算する
+_date_cache = {'start': 0.0, 'end': 0.0, 'date_str': ''}
+# /report の集計結果のキャッシュ (ユーザーID -> {(当日の日付, 日数): (取得時刻 (monotonic), 集計データ)})
+# そのユーザーのステータス時間をFirestoreに書き込んだ時点で破棄する
+_report_cache = {}
+REPORT_CACHE_TTL_SECONDS = 60
+REPORT_CACHE_MAX_USERS = 512 # これを超えた場合は最も古く登録されたユーザーから破棄する
+
+class StatusTable:
+    """ユーザーごとの直前のステータスコードと、その状態に移行した時刻 (time.monotonic()の値) を保持する表
+
+    ユーザーごとにオブジェクトを作らず、ユーザーID -> 行番号の辞書と、行番号で引く2つの配列
+    (ステータスコード: array('B')、時刻: array('d')) に分けて格納する (大規模サーバーでのメモリ削減のため)。
+    削除された行番号は再利用する。
+    """
+    __slots__ = ('id_to_idx', 'codes', 'timestamps', '_free')
+
+    def __init__(self):
+        self.id_to_idx: dict[int, int] = {}
+        self.codes = array('B')
+        self.timestamps = array('d')
+        self._free: list[int] = []
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.id_to_idx
+
+    def __len__(self) -> int:
+        return len(self.id_to_idx)
+
+    def index(self, user_id):
+        """ユーザーの行番号を返す (未登録の場合はNone)"""
+        return self.id_to_idx.get(user_id)
+
+    def add(self, user_id, code: int, ts: float) -> int:
+        """ユーザーを登録 (登録済みの場合は上書き) し、行番号を返す"""
+        idx = self.id_to_idx.get(user_id)
+        if idx is None:
+            if self._free:
+                idx = self._free.pop()
+            else:
+                idx = len(self.codes)
+                self.codes.append(0)
+                self.timestamps.append(0.0)
+            self.id_to_idx[user_id] = idx
+        self.codes[idx] = code
+        self.timestamps[idx] = ts
+        return idx
+
+    def add_missing(self, entries, ts: float) -> int:
+        """(ユーザーID, ステータスコード) の列のうち未登録のユーザーだけを時刻tsで一括登録し、登録数を返す
+
+        登録済みのユーザーはスキップする (再接続時の重複記録を防ぐ)。新しい行は配列にまとめてextendする。
+        """
+        id_to_idx = self.id_to_idx
+        free = self._free
+        next_idx = len(self.codes)
+        new_codes = array('B')
+        added = 0
+        for user_id, code in entries:
+            if user_id in id_to_idx:
+                continue
+            if free:
+                idx = free.pop()
+                self.codes[idx] = code
+                self.timestamps[idx] = ts
+            else:
+                idx = next_idx + len(new_codes)
+                new_codes.append(code)
+            id_to_idx[user_id] = idx
+            added += 1
+
+        self.codes.extend(new_codes)
+        self.timestamps.extend(array('d', [ts]) * len(new_codes))
+        return added
+
+    def remove(self, user_id) -> bool:
+        """ユーザーを削除し、行番号を再利用できるようにする (削除した場合はTrue)"""
+        idx = self.id_to_idx.pop(user_id, None)
+        if idx is None:
+            return False
+        self._free.append(idx)
+        return True
+
+# 直前のユーザーのステータスと、その状態に移行した時刻
+last_status_updates = StatusTable()
+
+class TokenBucket:
+    """一定時間あたりの実行回数を制限する非同期レートリミッター
+
+    Discordのチャンネルごとのレートリミット (固定の時間枠ごとの回数) に合わせ、トークンは連続的に補充せず、
+    per秒の時間枠が経過するたびにrate個まで一度に戻す (連続補充では最初の時間枠でrate個を超えて送信できてしまう)。
+    `async with bucket:` でトークンを1つ消費する。トークンが無い場合は次の時間枠まで待機する。
+    """
+
+    def __init__(self, rate: int = 5, per: float = 5.0):
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._window_start = monotonic()
+        self._lock = asyncio.Lock() # 待機中のタスクを到着順に処理する
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now - self._window_start >= self.per:
+                    # 時間枠が経過したので、新しい時間枠を開始してトークンを満タンに戻す
+                    self._window_start = now
+                    self._tokens = self.rate
+                if self._tokens > 0:
+                    self._tokens -= 1
+                    return
+                # 現在の時間枠が終わるまで待機する
+                await asyncio.sleep(self._window_start + self.per - now)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+def status_code(status) -> int:
+    """Discordのステータスを内部コードに変換する (不明なステータスは 'offline' として扱う)"""
+    return STATUS_CODES.get(str(status), OFFLINE_CODE)
+
+async def run_firestore(func, *args, **kwargs):
+    """Firestoreのblocking I/OをFirestore専用スレッドプールで実行し、完了を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(firestore_executor, functools.partial(func, *args, **kwargs))
+
+def daily_ref(collection_ref, user_id, day: str):
+    """ユーザーの指定日の日別集計ドキュメント ({collection_path}/{user_id}/daily/{YYYY-MM-DD}) の参照を返す"""
+    return collection_ref.document(str(user_id)).collection(DAILY_SUBCOLLECTION).document(day)
+
+def date_str_at(mono_ts: float) -> str:
+    """単調増加時計の時刻 (monotonic()の値) が属するJSTの日付を 'YYYY-MM-DD' 形式で返す
+
+    同じ日の間はキャッシュを返し、datetimeの生成とstrftimeは日付が変わった時のみ行う。
+    """
+    if _date_cache['start'] <= mono_ts < _date_cache['end']:
+        return _date_cache['date_str']
+
+    dt = datetime.now(tz_jst) - timedelta(seconds=monotonic() - mono_ts)
+    midnight = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = mono_ts - (dt - midnight).total_seconds()
+    _date_cache['start'] = start
+    _date_cache['end'] = start + 86400 # JSTには夏時間がないため、1日は常に86400秒
+    _date_cache['date_str'] = dt.strftime("%Y-%m-%d")
+    return _date_cache['date_str']
 
 # Renderのヘルスチェック用ルートを追加 (Webサーバーの安定稼働のために必須)
-@app.route('/')
-def health_check():
+@routes.get('/')
+async def health_check(request: web.Request) -> web.Response:
     """Renderのヘルスチェックに応答するためのルート。"""
-    global bot_thread, bot_ready_status # bot_ready_statusを追加
-    
     status = "Bot is starting or failed."
     
-    # Botスレッドが生きていれば
-    if bot_thread and bot_thread.is_alive():
+    # Botタスクが実行中であれば
+    if bot_task is not None and not bot_task.done():
         # Discordへの接続が完了していれば
-        if bot_ready_status:
+        # (グローバルフラグではなく、discord.pyがasyncio.Eventで管理する準備完了状態を参照する)
+        if bot.is_ready():
             status = "Bot is running and ready."
-        # スレッドは生きているが、まだ接続完了前であれば
+        # タスクは実行中だが、まだ接続完了前であれば
         else:
             status = "Bot is connecting..."
             
     # Botの状態を正確に反映
-    logging.info(f"Health Check: {status} (Process: {current_process().name})")
-    return f"Status Check: {status}", 200
+    logging.info(f"Health Check: {status} (Process ID: {os.getpid()})")
+    return web.Response(text=f"Status Check: {status}")
 
 # Botクライアントの定義
 class StatusTrackerBot(commands.Bot):
@@ -74,17 +284,87 @@ class StatusTrackerBot(commands.Bot):
         # ユーザーのステータスデータを保存するコレクションパス
         self.collection_path = f'artifacts/{self.app_id}/public/data/user_status'
         self.config_doc_ref = None
+        self._collection_ref = None # collection_pathのCollectionReferenceのキャッシュ (パスの再解析を避ける)
+        self._user_refs = {} # ユーザーID -> ユーザードキュメントのDocumentReferenceのキャッシュ
         self.report_channel_id = None # レポートチャンネルIDはサーバーIDではなく、チャンネルIDとして保存
+        self._report_channel = None # report_channel_idから解決したチャンネルオブジェクトのキャッシュ
+        self._config_watch = None # 設定ドキュメントの変更を監視するFirestoreリスナー (二重登録防止用)
+        self.db = None # Firestoreクライアント (init_firestore成功後にstart_botで設定される)
+        # Firestoreへの書き込み待ちのステータス時間 (ユーザーID -> {(日付, ステータス): 加算する秒数})
+        # 同じ日付・ステータスへの複数回の加算はメモリ上で合算し、フラッシュ時に1回のIncrementとして書き込む
+        # NOTE: バッファの加算・入れ替えはすべてイベントループ上でawaitを挟まずに行うため、ロックは不要
+        # (on_presence_updateはバッファへの加算だけで戻り、Firestoreの待ち時間の影響を受けない)
+        self._pending = defaultdict(lambda: defaultdict(float))
+        self._flush_task = None # バッファが閾値に達した時に起動した即時フラッシュのタスク
+        self._periodic_flush_task = None # 定期フラッシュのタスク (終了時に完了を待つ)
+        self._commands_synced = False # スラッシュコマンドのグローバル同期が完了したか (再接続時の再同期を防ぐ)
+        self._legacy_daily_migrated = False # 旧形式の日別フィールドの移行が完了済みか (設定ドキュメントの記録から読み込む)
+
+    async def setup_hook(self):
+        """ログイン前に一度だけ呼ばれる。書き込みバッファのフラッシュタスク、日別集計の整理タスク、日次レポートタスク、ステータス表の整理タスクを開始する
+
+        日次レポートタスクはレポートチャンネルの設定有無にかかわらず常に動かし、実行時点のreport_channel_idを参照する
+        (チャンネルの設定・変更時にタスクを停止・再開する必要がない)。
+        """
+        if not self.flush_pending_writes.is_running():
+            self.flush_pending_writes.start()
+        if not self.prune_daily_rollups.is_running():
+            self.prune_daily_rollups.start()
+        if not self.daily_report.is_running():
+            self.daily_report.start()
+        if not self.sweep_status_table.is_running():
+            self.sweep_status_table.start()
+
+    async def close(self):
+        """Bot終了時、バッファに残っているステータス時間を書き込んでから切断する"""
+        if self.flush_pending_writes.is_running():
+            self.flush_pending_writes.cancel()
+        if self._config_watch is not None:
+            # リスナーの停止はバックグラウンドスレッドの終了を待つblocking処理のため、Firestore専用スレッドプールで実行する
+            await run_firestore(self._config_watch.unsubscribe)
+            self._config_watch = None
+        # キャンセルしたループが実行中だったフラッシュと、即時フラッシュの完了を待つ
+        for flush_task in (self._periodic_flush_task, self._flush_task):
+            if flush_task is not None and not flush_task.done():
+                await flush_task
+        self._buffer_open_intervals()
+        await self._flush_pending_writes()
+        await super().close()
+        # 切断処理の待ち時間中にバッファされたステータス時間も書き込む
+        # (Firestore専用スレッドプールはここでは停止せず、stop_botで最後に停止する)
+        await self._flush_pending_writes()
+
+    def _buffer_open_intervals(self):
+        """各ユーザーの現在のステータスの経過時間 (まだ状態変更が起きていない分) をバッファに加算する
+
+        起動時の初期記録はメモリ上にしかないため、終了時にここで書き込まないと、
+        最後の状態変更から終了までの時間が記録されずに失われる。加算した分の開始時刻は現在時刻に進める。
+        """
+        if self.db is None:
+            return
+
+        now_ts = monotonic()
+        table = last_status_updates
+        codes, timestamps = table.codes, table.timestamps
+        buffered = 0
+        for user_id, idx in table.id_to_idx.items():
+            start_ts = timestamps[idx]
+            duration = now_ts - start_ts
+            if duration < MIN_WRITE_SECONDS:
+                continue
+            self._pending[user_id][(date_str_at(start_ts), STATUS_NAMES[codes[idx]])] += duration
+            timestamps[idx] = now_ts
+            buffered += 1
+        logging.debug(f"Buffered in-progress status time for {buffered} users.")
 
     async def _initialize_db_references(self):
         """dbが初期化された後、ドキュメント参照を設定する"""
-        global db
-        if db is not None and self.config_doc_ref is None:
+        if self.db is not None and self.config_doc_ref is None:
             logging.debug("Firestore Document References initialization.")
             # Botの設定（レポートチャンネルIDなど）を保存する場所
-            self.config_doc_ref = db.collection(f'artifacts/{self.app_id}/public/data/bot_config').document('settings')
-            return True
-        return False
+            self.config_doc_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/bot_config').document('settings')
+        # 再接続時など、既に初期化済みの場合もTrueを返す
+        return self.config_doc_ref is not None
 
     async def _load_config(self):
         """FirestoreからレポートチャンネルIDをロードする"""
@@ -93,10 +373,23 @@ class StatusTrackerBot(commands.Bot):
             return False
 
         try:
-            # blocking I/O (Firestore get)をasyncio.to_threadで非同期に実行
-            doc = await asyncio.to_thread(self.config_doc_ref.get)
-            if doc.exists and 'report_channel_id' in doc.to_dict():
-                self.report_channel_id = doc.to_dict()['report_channel_id']
+            # 以降の設定変更はリスナー経由でリアルタイムに反映する (登録は一度だけ)
+            # リスナーの登録と現在の設定の取得は、1回のスレッド切り替えでまとめて行う
+            register_watch = self._config_watch is None
+            def load():
+                watch = self.config_doc_ref.on_snapshot(self._on_config_snapshot) if register_watch else None
+                return watch, self.config_doc_ref.get()
+
+            # blocking I/O (Firestore get)をFirestore専用スレッドプールで非同期に実行
+            watch, doc = await run_firestore(load)
+            if watch is not None:
+                self._config_watch = watch
+                logging.debug("Firestore config listener registered.")
+
+            config = doc.to_dict() if doc.exists else None
+            if config and 'report_channel_id' in config:
+                self.report_channel_id = config['report_channel_id']
+                self._report_channel = self.get_channel(self.report_channel_id) # キャッシュ未取得の場合はNone
                 logging.info(f"✅ FirestoreからレポートチャンネルIDをロード: {self.report_channel_id}")
                 return True
             else:
@@ -106,6 +399,21 @@ class StatusTrackerBot(commands.Bot):
             logging.error(f"❌ 設定ロード中にエラーが発生しました: {e}", exc_info=True)
             return False
 
+    def _on_config_snapshot(self, doc_snapshots, changes, read_time):
+        """(Firestoreのリスナースレッドから呼ばれる) 設定ドキュメントの変更をBotのイベントループに渡す"""
+        data = doc_snapshots[0].to_dict() if doc_snapshots and doc_snapshots[0].exists else {}
+        asyncio.run_coroutine_threadsafe(self._apply_config(data or {}), self.loop)
+
+    async def _apply_config(self, data: dict):
+        """Firestoreのリスナーで受け取った設定をBotの状態に反映する"""
+        channel_id = data.get('report_channel_id')
+        if channel_id is None or channel_id == self.report_channel_id:
+            return
+
+        self.report_channel_id = channel_id
+        self._report_channel = self.get_channel(channel_id)
+        logging.info(f"🔄 FirestoreでレポートチャンネルIDの変更を検知しました: {channel_id}")
+
     async def _save_config(self, channel_id: int):
         """FirestoreにレポートチャンネルIDを保存する"""
         if not await self._initialize_db_references():
@@ -114,20 +422,38 @@ class StatusTrackerBot(commands.Bot):
 
         try:
             logging.debug(f"Attempting to save report channel ID: {channel_id}")
-            # blocking I/O (Firestore set)をasyncio.to_threadで非同期に実行
-            await asyncio.to_thread(self.config_doc_ref.set, 
-                                    {'report_channel_id': channel_id}, 
-                                    merge=True)
+            # blocking I/O (Firestore set)をFirestore専用スレッドプールで非同期に実行
+            await run_firestore(self.config_doc_ref.set, 
+                                {'report_channel_id': channel_id}, 
+                                merge=True)
             self.report_channel_id = channel_id
+            self._report_channel = self.get_channel(channel_id)
             logging.info(f"✅ レポートチャンネルIDをFirestoreに保存しました: {channel_id}")
             return True
         except Exception as e:
             logging.error(f"❌ 設定保存中にエラーが発生しました: {e}", exc_info=True)
             return False
 
-    async def on_ready(self):
-        global bot_ready_status # グローバルフラグにアクセス
+    def _get_collection_ref(self):
+        """ユーザーステータスのコレクション参照を返す (初回のみ作成し、以降はキャッシュを返す)"""
+        if self._collection_ref is None:
+            self._collection_ref = self.db.collection(self.collection_path)
+        return self._collection_ref
+
+    def _get_user_ref(self, user_id):
+        """ユーザードキュメントの参照を返す (初回のみ作成し、以降はキャッシュを返す)"""
+        user_ref = self._user_refs.get(user_id)
+        if user_ref is None:
+            user_ref = self._user_refs[user_id] = self._get_collection_ref().document(str(user_id))
+        return user_ref
+
+    def _get_report_channel(self):
+        """レポートチャンネルを返す (キャッシュが無い場合のみget_channelで解決し、結果をキャッシュする)"""
+        if self._report_channel is None and self.report_channel_id is not None:
+            self._report_channel = self.get_channel(self.report_channel_id)
+        return self._report_channel
 
+    async def on_ready(self):
         # 起動成功の確実なログ
         logging.info('---------------------------------')
         logging.info(f'✅ Botがログインしました: {self.user.name} (ID: {self.user.id})')
@@ -135,53 +461,27 @@ class StatusTrackerBot(commands.Bot):
         for guild in self.guilds:
             logging.info(f'   - {guild.name} (ID: {guild.id})')
         
-        # Botの準備完了フラグをTrueに設定
-        bot_ready_status = True 
-        
         # 1. データベース設定のロード
         await self._load_config()
 
-        # 2. コマンドの強制同期 (グローバルコマンドとして同期)
-        try:
-            logging.info("--- 🔄 グローバルへの強制同期処理開始 ---")
-            # サーバーの数が多い場合、Botがログインするまで待つ必要があります
-            await asyncio.sleep(5) 
-            await self.tree.sync() 
-            logging.info("--- ✅ グローバルへのコマンド同期完了 ---")
-
-        except Exception as e:
-            logging.warning(f"⚠️ 警告: スラッシュコマンド同期中のエラー: {e}")
-            
-        # 3. 記録漏れを防ぐための初期ステータス記録
-        now = datetime.now(tz_jst)
+        # 2. 記録漏れを防ぐための初期ステータス記録 (コマンド同期の待ち時間中のステータス変更も記録できるよう、先に行う)
+        now_ts = monotonic()
         logging.info("--- 📊 ユーザーの初期ステータスを取得しています ---")
         
         for guild in self.guilds:
             try:
-                logging.debug(f"Fetching members for Guild: {guild.name} ({guild.id})")
-                await guild.chunk() # メンバーキャッシュを強制的に取得
+                # members Intentが有効な場合、discord.pyは起動時 (on_readyの前) に全サーバーのメンバー一覧を取得済みのため、
+                # 取得できていないサーバーのみ改めて取得する (guild.chunk()は取得済みでも毎回全メンバーを再ダウンロードする)
+                if not guild.chunked:
+                    logging.debug(f"Fetching members for Guild: {guild.name} ({guild.id})")
+                    await guild.chunk() # メンバーキャッシュを強制的に取得
                 
-                member_count = 0
-                for member in guild.members:
-                    if member.bot:
-                        continue
-                    
-                    member_count += 1
-                    user_id = member.id
-                    
-                    # 既に記録があるユーザーはスキップ（再起動時の重複記録を防ぐ）
-                    if user_id in last_status_updates:
-                        continue
-                    
-                    status_key = str(member.status)
-                    
-                    # 'invisible' は 'offline' として扱う
-                    if status_key == 'invisible':
-                        status_key = 'offline'
-                        
-                    last_status_updates[user_id] = (status_key, now)
-                    
-                logging.debug(f"Recorded initial status for {member_count} members in {guild.name}")
+                # 既に記録があるユーザーはスキップし、未登録のメンバーだけを一括で登録する（再起動時の重複記録を防ぐ）
+                member_count = last_status_updates.add_missing(
+                    ((member.id, status_code(member.status)) for member in guild.members if not member.bot),
+                    now_ts,
+                )
+                logging.debug(f"Recorded initial status for {member_count} new members in {guild.name}")
             except discord.Forbidden:
                 logging.warning(f"⚠️ 警告: サーバー '{guild.name}' ({guild.id}) でメンバー情報の読み取りが拒否されました。PRESENCE INTENTとSERVER MEMBERS INTENTを確認してください。")
             except Exception as e:
@@ -189,11 +489,23 @@ class StatusTrackerBot(commands.Bot):
 
         logging.info("✅ 初期ステータス記録完了。")
 
-        # 4. 定期タスクの開始
+        # 3. コマンドの強制同期 (グローバルコマンドとして同期)
+        # 再接続でon_readyが再度呼ばれた場合は、同期済みのため行わない
+        if not self._commands_synced:
+            try:
+                logging.info("--- 🔄 グローバルへの強制同期処理開始 ---")
+                # サーバーの数が多い場合、Botがログインするまで待つ必要があります
+                await asyncio.sleep(5) 
+                await self.tree.sync() 
+                self._commands_synced = True
+                logging.info("--- ✅ グローバルへのコマンド同期完了 ---")
+
+            except Exception as e:
+                logging.warning(f"⚠️ 警告: スラッシュコマンド同期中のエラー: {e}")
+            
+        # 4. 日次レポートの送信先の確認 (タスク自体はsetup_hookで開始済み)
         if self.report_channel_id is not None:
-            if not self.daily_report.is_running():
-                self.daily_report.start()
-                logging.info(f"✅ 日次レポートタスクを開始しました。送信先: {self.report_channel_id}")
+            logging.info(f"✅ 日次レポートの送信先: {self.report_channel_id}")
         else:
             logging.info("ℹ️ レポートチャンネルIDが未設定のため、自動送信をスキップします。/set_report_channelで設定してください。")
             
@@ -218,85 +530,99 @@ class StatusTrackerBot(commands.Bot):
 
     async def on_presence_update(self, before: discord.Member, after: discord.Member):
         # Bot自身、またはデータベースが未接続の場合はスキップ
-        if after.id == self.user.id or db is None:
+        if after.id == self.user.id or self.db is None:
             return
 
         user_id = after.id
-        doc_ref = db.collection(self.collection_path).document(str(user_id))
-        now = datetime.now(tz_jst)
-        
-        # ログ記録のための情報取得
-        guild_info = f"Guild: {after.guild.name} ({after.guild.id})"
-        user_info = f"{after.display_name} ({after.id})"
-        log_time = now.strftime("%Y-%m-%d %H:%M:%S JST")
         
         # ------------------------------------------------------------------
         # 1. プレゼンスの変更ログ (ステータス、アクティビティ、ニックネーム)
         # ------------------------------------------------------------------
-        
-        # ステータス変更のログ
-        if before.status != after.status:
-            logging.info(f"[{log_time}] [STATUS CHANGE] {user_info} {guild_info} | Status: {before.status} -> {after.status}")
-        
-        # アクティビティ変更のログ
-        if before.activities != after.activities:
-            # ログ出力のためにアクティビティを整形
-            before_activities = ", ".join([format_activity(a) for a in before.activities]) if before.activities else "None"
-            after_activities = ", ".join([format_activity(a) for a in after.activities]) if after.activities else "None"
-            logging.info(f"[{log_time}] [ACTIVITY CHANGE] {user_info} {guild_info} | Activities: Before='{before_activities}' | After='{after_activities}'")
-
-        # ニックネーム変更のログ
-        if before.display_name != after.display_name:
-            logging.info(f"[{log_time}] [NICK CHANGE] {user_info} {guild_info} | Nickname: '{before.display_name}' -> '{after.display_name}'")
-            
+        status_changed = before.status != after.status
+
+        # INFOログが無効な場合は、ログ出力のための比較と文字列の生成をすべて省く
+        if logging.root.isEnabledFor(logging.INFO):
+            activities_changed = before.activities != after.activities
+            nick_changed = before.display_name != after.display_name
+
+            # ログに出力する変更がある場合のみ、ログ記録のための情報 (JST時刻など) を生成する
+            if status_changed or activities_changed or nick_changed:
+                guild_info = f"Guild: {after.guild.name} ({after.guild.id})"
+                user_info = f"{after.display_name} ({after.id})"
+                log_time = datetime.now(tz_jst).strftime("%Y-%m-%d %H:%M:%S JST")
+
+                # ステータス変更のログ
+                if status_changed:
+                    logging.info(f"[{log_time}] [STATUS CHANGE] {user_info} {guild_info} | Status: {before.status} -> {after.status}")
+
+                # アクティビティ変更のログ
+                if activities_changed:
+                    # ログ出力のためにアクティビティを整形
+                    before_activities = ", ".join([format_activity(a) for a in before.activities]) if before.activities else "None"
+                    after_activities = ", ".join([format_activity(a) for a in after.activities]) if after.activities else "None"
+                    logging.info(f"[{log_time}] [ACTIVITY CHANGE] {user_info} {guild_info} | Activities: Before='{before_activities}' | After='{after_activities}'")
+
+                # ニックネーム変更のログ
+                if nick_changed:
+                    logging.info(f"[{log_time}] [NICK CHANGE] {user_info} {guild_info} | Nickname: '{before.display_name}' -> '{after.display_name}'")
+
         # ------------------------------------------------------------------
         # 2. ステータス時間記録処理
         # ------------------------------------------------------------------
+
+        # アクティビティやニックネームのみの変更 (ステータスは同じ) の場合は、時間記録処理を行わない
+        if not status_changed:
+            return
         
-        # 時間記録のために、'invisible' は 'offline' として扱う
-        current_status_key = str(after.status)
-        if current_status_key == 'invisible':
-            current_status_key = 'offline'
+        # 時間記録のために、'invisible' は 'offline' として扱う (status_codeで同じコードに変換)
+        current_code = status_code(after.status)
 
         # 起動時の初期記録があるか確認
-        if user_id in last_status_updates:
-            prev_status_key, prev_time = last_status_updates[user_id]
-        else:
+        table = last_status_updates
+        idx = table.index(user_id)
+        if idx is None:
             # last_status_updatesにないがon_presence_updateが呼ばれた場合 (例外的な処理、通常はon_readyで設定される)
-            logging.warning(f"[{log_time}] ⚠️ Missing initial status for {user_info}. Assuming 'offline' start time is 'now'.")
-            prev_status_key = str(before.status) if before.status else 'offline'
-            if prev_status_key == 'invisible':
-                prev_status_key = 'offline'
-            prev_time = now
-
-        # ステータスが変わっていない場合は時間記録処理を終了
-        if current_status_key == prev_status_key:
+            logging.warning(f"⚠️ Missing initial status for {after.display_name} ({user_id}). Assuming the previous status started 'now'.")
+            idx = table.add(user_id, status_code(before.status), monotonic())
+
+        # 記録上のステータスと同じ場合 (offline↔invisible等、時間記録上は同じステータスへの変更) は、時刻を取得する前に終了
+        prev_code = table.codes[idx]
+        if current_code == prev_code:
             return
             
-        duration = (now - prev_time).total_seconds()
-        
-        # 記録する前のステータス名
-        field_name = f'{prev_status_key}_seconds'
-        
-        # 状態変更が日をまたいだ場合を考慮し、記録は「前のステータスが続いていた日」の日付を使用
-        prev_date_str = prev_time.strftime("%Y-%m-%d")
-        date_field_name = f'{prev_date_str}_{field_name}'
-
-        if duration > 0:
-            logging.debug(f"[{log_time}] Recording time for {user_id}. Duration: {duration:.2f}s for {prev_status_key} on {prev_date_str}.")
-            # FirestoreのIncrement機能を利用して、安全に時間を加算
-            try:
-                await asyncio.to_thread(doc_ref.set, {
-                    field_name: firestore.Increment(duration), # ステータスごとの合計時間
-                    date_field_name: firestore.Increment(duration), # 日付+ステータスごとの合計時間
-                    'last_updated': now
-                }, merge=True) 
-                logging.debug(f"✅ Firestore updated successfully for {user_id}.")
-            except Exception as e:
-                logging.error(f"❌ Firestoreへのステータス時間記録中にエラーが発生しました: {e}", exc_info=True)
+        # 経過時間は単調増加時計の差分のみで計算する
+        now_ts = monotonic()
+        prev_ts = table.timestamps[idx]
+        duration = now_ts - prev_ts
+
+        # 一瞬だけのステータス変化 (online↔idleのちらつき等) は記録せず、開始時刻を据え置いたまま
+        # 新しいステータスに切り替える (短い時間は次のステータスの時間に含まれ、合計時間は失われない)
+        if duration < MIN_WRITE_SECONDS:
+            # DEBUGログが無効な場合は、ログ用の文字列を生成しない (以下同様)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(f"Folding {duration:.2f}s of {STATUS_NAMES[prev_code]} into the next status for {user_id}.")
+            table.codes[idx] = current_code
+            return
 
         # 最後の更新時刻を新しいステータスと時刻で更新
-        last_status_updates[user_id] = (current_status_key, now)
+        table.codes[idx] = current_code
+        table.timestamps[idx] = now_ts
+
+        if duration > 0:
+            prev_status_key = STATUS_NAMES[prev_code]
+            # 状態変更が日をまたいだ場合を考慮し、記録は「前のステータスが続いていた日」の日付を使用
+            # (日付はキャッシュから引き、壁時計の時刻は日付が変わった時のみ生成する)
+            prev_date_str = date_str_at(prev_ts)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(f"Buffering time for {user_id}. Duration: {duration:.2f}s for {prev_status_key} on {prev_date_str}.")
+            # Firestoreへは直接書き込まず、バッファに加算してフラッシュタスクでまとめて書き込む
+            self._pending[user_id][(prev_date_str, prev_status_key)] += duration
+            pending_users = len(self._pending)
+
+            # バーストでバッファが大きくなった場合は、定期フラッシュを待たずに書き込む
+            if pending_users >= FLUSH_THRESHOLD_USERS and (self._flush_task is None or self._flush_task.done()):
+                logging.debug(f"Pending buffer reached {pending_users} users. Flushing early.")
+                self._flush_task = asyncio.create_task(self._flush_pending_writes())
         
     async def on_member_join(self, member):
         # Bot自身または他のBotはスキップ
@@ -312,10 +638,8 @@ class StatusTrackerBot(commands.Bot):
         
         # last_status_updates に初期ステータスを登録
         if member.id not in last_status_updates:
-             # 'invisible' は 'offline' として扱う
-             if status_key == 'invisible':
-                 status_key = 'offline'
-             last_status_updates[member.id] = (status_key, now)
+             # 'invisible' は 'offline' として扱う (status_codeで同じコードに変換)
+             last_status_updates.add(member.id, status_code(member.status), monotonic())
              logging.debug(f"Initial status set for new member {member.id}.")
         else:
              logging.debug(f"Member {member.id} already exists in last_status_updates (should not happen on join).")
@@ -329,11 +653,41 @@ class StatusTrackerBot(commands.Bot):
         log_time = now.strftime("%Y-%m-%d %H:%M:%S JST")
         logging.info(f"[{log_time}] 🚪 Member Left! Guild: {member.guild.name} ({member.guild.id}), User: {member.display_name} ({member.id})")
 
-        # last_status_updates から削除（メモリ解放のため）
-        if member.id in last_status_updates:
-            del last_status_updates[member.id]
+        # last_status_updates、ドキュメント参照と /report 集計結果のキャッシュから削除（メモリ解放のため）
+        self._user_refs.pop(member.id, None)
+        invalidate_report_cache((member.id,))
+        if last_status_updates.remove(member.id):
             logging.debug(f"Member {member.id} removed from last_status_updates.")
         
+    async def on_disconnect(self):
+        # Gatewayから切断された場合 (再接続前) は、定期フラッシュを待たずにバッファを書き込む
+        # Botの終了処理中 (close()による切断) は、close()が最後にフラッシュするため何もしない
+        if self.is_closed():
+            return
+        logging.debug("Gateway disconnected. Flushing pending status writes.")
+        await self._flush_pending_writes()
+
+    async def on_guild_channel_delete(self, channel):
+        # レポートチャンネルが削除された場合はキャッシュを破棄する
+        if channel.id == self.report_channel_id:
+            self._report_channel = None
+            logging.warning(f"⚠️ 警告: レポートチャンネル #{channel.name} ({channel.id}) が削除されました。/set_report_channelで再設定してください。")
+
+    async def on_guild_remove(self, guild):
+        logging.info(f"🚪 サーバーから削除されました: {guild.name} ({guild.id})")
+
+        # 他のサーバーに属していないメンバーは、last_status_updates とドキュメント参照のキャッシュから削除する（メモリ解放のため）
+        # (on_member_removeはBotがサーバーから削除された場合には呼ばれない)
+        other_member_ids = {member.id for other in self.guilds if other.id != guild.id for member in other.members}
+        removed = 0
+        for member in guild.members:
+            if member.id in other_member_ids:
+                continue
+            self._user_refs.pop(member.id, None)
+            if last_status_updates.remove(member.id):
+                removed += 1
+        logging.debug(f"Removed {removed} members of guild {guild.id} from last_status_updates.")
+
     async def on_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
         """スラッシュコマンド実行中に発生したエラーを処理する"""
         
@@ -374,19 +728,231 @@ class StatusTrackerBot(commands.Bot):
                 logging.error(f"応答送信時の HTTP エラー: {e}")
             
     # ----------------------------------------------------
-    # 日次レポートタスク (毎日 JST 00:00 実行)
+    # 書き込みバッファのフラッシュタスク
+    # ----------------------------------------------------
+    @tasks.loop(seconds=FLUSH_INTERVAL_SECONDS)
+    async def flush_pending_writes(self):
+        # 終了時にループをキャンセルしても書き込み途中のフラッシュが中断されないよう、別タスクで実行してshieldで待つ
+        # (バッファは入れ替え済みのため、中断されると書き込みも再キューもされずに失われる)
+        self._periodic_flush_task = asyncio.create_task(self._flush_pending_writes())
+        await asyncio.shield(self._periodic_flush_task)
+
+    async def _flush_pending_writes(self):
+        """バッファに溜まったステータス時間をWriteBatchでまとめてFirestoreに書き込む
+
+        ステータス時間はdailyサブコレクションの1日1ドキュメントの日別集計 (ステータスごとの秒数と合計) にのみ加算し、
+        ユーザードキュメントには最終更新時刻だけを記録する。
+        """
+        if self.db is None:
+            return
+
+        # バッファを入れ替え、以降の加算は新しいバッファに溜める
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = defaultdict(lambda: defaultdict(float))
+
+        # 1ユーザー分の書き込みが複数のバッチに分かれないよう、ユーザー単位でバッチに詰める
+        # (コミットに失敗したバッチのユーザーだけを、二重加算なくバッファに戻せるようにするため)
+        chunks = [] # [(書き込み対象のユーザーIDのリスト, [(ドキュメント参照, 書き込み内容), ...]), ...]
+        chunk_users, chunk_writes = [], []
+
+        for user_id, increments in pending.items():
+            user_ref = self._get_user_ref(user_id)
+            daily = defaultdict(lambda: defaultdict(float))
+            for (day, status), seconds in increments.items():
+                daily[day][status] += seconds
+
+            # ステータス時間は日別集計にのみ加算し、ユーザードキュメントには最終更新時刻だけを書き込む
+            # (ユーザードキュメントは整理タスクがユーザーを列挙するために必要)
+            # 最終更新時刻はサーバー側の時刻で記録する (クライアントでdatetimeを生成せず、時計のずれの影響も受けない)
+            user_writes = [(user_ref, {'last_updated': firestore.SERVER_TIMESTAMP})]
+
+            for day, status_seconds in daily.items():
+                daily_payload = {status: firestore.Increment(seconds) for status, seconds in status_seconds.items()}
+                daily_payload['total'] = firestore.Increment(sum(status_seconds.values()))
+                user_writes.append((user_ref.collection(DAILY_SUBCOLLECTION).document(day), daily_payload))
+
+            if chunk_writes and len(chunk_writes) + len(user_writes) > FIRESTORE_BATCH_LIMIT:
+                chunks.append((chunk_users, chunk_writes))
+                chunk_users, chunk_writes = [], []
+            chunk_users.append(user_id)
+            chunk_writes.extend(user_writes)
+
+        if chunk_writes:
+            chunks.append((chunk_users, chunk_writes))
+
+        async def commit_chunk(chunk_users, chunk_writes):
+            batch = self.db.batch()
+            for doc_ref, payload in chunk_writes:
+                batch.set(doc_ref, payload, merge=True)
+
+            try:
+                # blocking I/O (Firestore commit)をFirestore専用スレッドプールで非同期に実行
+                await run_firestore(batch.commit)
+                logging.debug(f"✅ Firestore batch committed ({len(chunk_writes)} writes).")
+                # 書き込んだユーザーの /report キャッシュは古くなるため破棄する
+                invalidate_report_cache(chunk_users)
+            except Exception as e:
+                logging.error(f"❌ Firestoreへのステータス時間の一括書き込み中にエラーが発生しました。次回のフラッシュで再試行します: {e}", exc_info=True)
+                # 書き込めなかった分はバッファに戻し、次回のフラッシュで新しい加算と合わせて書き込む
+                for user_id in chunk_users:
+                    requeued = self._pending[user_id]
+                    for key, seconds in pending[user_id].items():
+                        requeued[key] += seconds
+
+        # バッチ同士は別々のユーザーへの書き込みのため、順番に待たずに並行してコミットする
+        await asyncio.gather(*(commit_chunk(chunk_users, chunk_writes) for chunk_users, chunk_writes in chunks))
+
+    # ----------------------------------------------------
+    # 日別集計の整理タスク (保持期間を過ぎたドキュメントを削除)
+    # ----------------------------------------------------
+    @tasks.loop(hours=24)
+    async def prune_daily_rollups(self):
+        if self.db is None:
+            return
+
+        cutoff_date = (datetime.now(tz_jst) - timedelta(days=DAILY_ROLLUP_RETENTION_DAYS)).strftime("%Y-%m-%d")
+        try:
+            # 移行完了の記録を設定ドキュメントに読み書きするため、参照を初期化しておく
+            await self._initialize_db_references()
+            # 一連のblocking I/OをまとめてFirestore専用スレッドプールで非同期に実行
+            deleted, migrated = await run_firestore(self._delete_rollups_before, cutoff_date)
+            if migrated:
+                # 旧形式のフィールドから移行した分は /report の集計結果に反映されていないため、キャッシュをすべて破棄する
+                _report_cache.clear()
+                logging.info(f"🔀 旧形式の日別フィールド {migrated} 件を日別集計ドキュメントに移行しました。")
+            logging.info(f"🧹 {cutoff_date} より前の日別集計を {deleted} 件削除しました。")
+        except Exception as e:
+            logging.error(f"❌ 日別集計ドキュメントの削除中にエラーが発生しました: {e}", exc_info=True)
+
+    @prune_daily_rollups.before_loop
+    async def before_prune_daily_rollups(self):
+        await self.wait_until_ready()
+
+    def _delete_rollups_before(self, cutoff_date: str) -> tuple:
+        """(同期処理) cutoff_dateより前の日付の日別集計を全ユーザー分削除し、(削除件数, 移行したフィールド数) を返す
+
+        ユーザードキュメントに残っている旧形式の日別フィールド ('YYYY-MM-DD_<status>_seconds') は、
+        保持期間内のものを日別集計ドキュメントへIncrementで加算してから、保持期間にかかわらずすべて削除する。
+        加算とフィールドの削除は同じバッチでコミットするため、途中で失敗しても二重に加算されない。
+        """
+        deleted = 0
+        migrated = 0
+        batch = self.db.batch()
+        batch_size = 0
+
+        def add_writes(writes):
+            """書き込みの組 [(種類, ドキュメント参照, 内容), ...] を、分割せずに1つのバッチに追加する"""
+            nonlocal batch, batch_size
+            if batch_size + len(writes) > FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch = self.db.batch()
+                batch_size = 0
+            for kind, doc_ref, payload in writes:
+                if kind == 'set':
+                    batch.set(doc_ref, payload, merge=True)
+                elif kind == 'update':
+                    batch.update(doc_ref, payload)
+                else:
+                    batch.delete(doc_ref)
+            batch_size += len(writes)
+
+        # 旧形式のフィールドの移行が完了していれば、ユーザードキュメントの中身は読まずに参照だけを列挙する
+        # (list_documentsはドキュメント本体を転送せず、dailyサブコレクションだけを持つユーザーも含む)
+        if not self._legacy_daily_migrated:
+            marker = self.config_doc_ref.get(field_paths=['legacy_daily_migrated'])
+            self._legacy_daily_migrated = bool((marker.to_dict() or {}).get('legacy_daily_migrated'))
+        migrating = not self._legacy_daily_migrated
+        collection_ref = self._get_collection_ref()
+        if migrating:
+            users = ((snapshot.reference, snapshot.to_dict()) for snapshot in collection_ref.stream())
+        else:
+            users = ((user_ref, None) for user_ref in collection_ref.list_documents())
+
+        for user_ref, data in users:
+            if data:
+                # 旧形式のフィールドを日付ごとにまとめる (日付 -> フィールド名のリスト / ステータス -> 秒数)
+                legacy_fields = defaultdict(list)
+                legacy_seconds = defaultdict(lambda: defaultdict(float))
+                for field, value in data.items():
+                    match = LEGACY_DAILY_FIELD.match(field)
+                    if not match:
+                        continue
+                    day, status = match.groups()
+                    legacy_fields[day].append(field)
+                    if day >= cutoff_date and value:
+                        # 'invisible' など旧形式のステータス名は、現在の記録と同じステータスに変換する
+                        legacy_seconds[day][STATUS_NAMES[status_code(status)]] += value
+
+                # 1つのバッチに収まるよう日付を分けて、日別集計への加算と旧フィールドの削除を組にする
+                days = list(legacy_fields)
+                for start in range(0, len(days), FIRESTORE_BATCH_LIMIT - 1):
+                    group = days[start:start + FIRESTORE_BATCH_LIMIT - 1]
+                    writes = []
+                    for day in group:
+                        status_seconds = legacy_seconds.get(day)
+                        if status_seconds:
+                            daily_payload = {status: firestore.Increment(seconds) for status, seconds in status_seconds.items()}
+                            daily_payload['total'] = firestore.Increment(sum(status_seconds.values()))
+                            writes.append(('set', user_ref.collection(DAILY_SUBCOLLECTION).document(day), daily_payload))
+                    writes.append(('update', user_ref, {
+                        FieldPath(field).to_api_repr(): firestore.DELETE_FIELD
+                        for day in group for field in legacy_fields[day]
+                    }))
+                    add_writes(writes)
+                    migrated += sum(len(legacy_fields[day]) for day in group if day in legacy_seconds)
+
+            daily_collection = user_ref.collection(DAILY_SUBCOLLECTION)
+            query = daily_collection.where(filter=firestore.FieldFilter(FieldPath.document_id(), '<', daily_collection.document(cutoff_date)))
+            for snapshot in query.stream():
+                add_writes([('delete', snapshot.reference, None)])
+                deleted += 1
+
+        if batch_size:
+            batch.commit()
+        if migrating:
+            # 全ユーザーの移行が完了したことを記録し、次回以降はドキュメント本体を読まない
+            self.config_doc_ref.set({'legacy_daily_migrated': True}, merge=True)
+            self._legacy_daily_migrated = True
+        return deleted, migrated
+
+    # ----------------------------------------------------
+    # ステータス表の整理タスク (どのサーバーにも属さなくなったユーザーの行を削除)
     # ----------------------------------------------------
-    @tasks.loop(time=time(0, 0, tzinfo=tz_jst)) 
+    @tasks.loop(hours=24)
+    async def sweep_status_table(self):
+        """on_member_removeで削除されなかったユーザー (Botが退出したサーバーのメンバーなど) の行を削除する"""
+        # メンバー一覧を取得できていないサーバーがある場合、在籍中のユーザーを誤って削除しないよう見送る
+        if not all(guild.chunked for guild in self.guilds):
+            logging.debug("Skipping status table sweep: some guilds are not chunked yet.")
+            return
+
+        member_ids = {member.id for guild in self.guilds for member in guild.members}
+        stale_ids = [user_id for user_id in last_status_updates.id_to_idx if user_id not in member_ids]
+        for user_id in stale_ids:
+            last_status_updates.remove(user_id)
+            self._user_refs.pop(user_id, None)
+        logging.info(f"🧹 ステータス表から {len(stale_ids)} 人の不要な行を削除しました (残り: {len(last_status_updates)} 人)。")
+
+    @sweep_status_table.before_loop
+    async def before_sweep_status_table(self):
+        await self.wait_until_ready()
+
+    # ----------------------------------------------------
+    # 日次レポートタスク (毎日 JST DAILY_REPORT_TIME に実行)
+    # ----------------------------------------------------
+    @tasks.loop(time=DAILY_REPORT_TIME)
     async def daily_report(self):
-        logging.info("--- 🔄 日次レポートタスク開始前の設定再ロード ---")
-        # タスク実行前に設定を再ロード
-        await self._load_config() 
-        
-        if not self.is_ready() or db is None or self.report_channel_id is None:
+        # NOTE: 設定はon_readyでのロードとFirestoreのリスナーで常に最新に保たれるため、ここでは再ロードしない
+        if self.report_channel_id is None:
+            logging.info("ℹ️ レポートチャンネルIDが未設定のため、日次レポートをスキップします。")
+            return
+        if not self.is_ready() or self.db is None:
             logging.warning("⚠️ 警告: レポートタスクの実行条件が満たされていません。タスクをスキップします。")
             return
 
-        report_channel = self.get_channel(self.report_channel_id)
+        report_channel = self._get_report_channel()
         if not report_channel:
             logging.warning(f"⚠️ 警告: レポートチャンネルID {self.report_channel_id} が無効です。")
             return
@@ -394,19 +960,53 @@ class StatusTrackerBot(commands.Bot):
         # チャンネルが属するサーバーIDを取得
         target_guild = report_channel.guild
         
-        logging.info(f"--- 📅 日次レポート処理開始 ({target_guild.name} / ID: {target_guild.id}, JST 00:00) ---")
+        logging.info(f"--- 📅 日次レポート処理開始 ({target_guild.name} / ID: {target_guild.id}, JST {DAILY_REPORT_TIME_TEXT}) ---")
 
-        days = 1 # 昨日1日間のレポート
-        
-        member_reports_sent = 0
-        
-        # 全メンバー（Bot以外）を対象にレポートを作成し、送信
-        for member in target_guild.members:
-            if member.bot:
-                continue
-            
-            # ユーザーのデータを取得 (昨日1日分)
-            user_data = await get_user_report_data(member, db, self.collection_path, days=days)
+        # 日付が変わった直後 (DAILY_REPORT_TIME) に実行されるため、集計対象は「昨日」の日別集計ドキュメント
+        # 集計対象日とフッターの生成時刻は、同じ現在時刻から一度だけ求める
+        now = datetime.now(tz_jst)
+        report_start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        report_date = report_start.strftime("%Y-%m-%d")
+        collection_ref = self._get_collection_ref()
+
+        try:
+            # 昨日の日別集計は昨日0時以降のフラッシュでしか書き込まれないため、
+            # last_updatedが昨日0時以降のユーザーだけをクエリで絞り込む (活動の無いメンバーの日別集計を読まない)
+            active_query = collection_ref.where(filter=firestore.FieldFilter('last_updated', '>=', report_start)).select(['last_updated'])
+            active_ids = await run_firestore(lambda: {snapshot.id for snapshot in active_query.stream()})
+        except Exception as e:
+            logging.error(f"❌ 日次レポート対象ユーザーの取得中にエラーが発生しました: {e}", exc_info=True)
+            return
+
+        members = [member for member in target_guild.members if not member.bot and str(member.id) in active_ids]
+        daily_refs = [daily_ref(collection_ref, member.id, report_date) for member in members]
+
+        try:
+            # 対象メンバー分の日別集計ドキュメントをget_allで一括取得する
+            # 大規模サーバーでは参照を分割し、Firestore専用スレッドプールで並行して取得する (同時実行数はプールの大きさで制限される)
+            chunk_results = await asyncio.gather(*(
+                run_firestore(lambda refs=daily_refs[start:start + GET_ALL_CHUNK_SIZE]: list(self.db.get_all(refs, field_paths=ROLLUP_FIELD_PATHS)))
+                for start in range(0, len(daily_refs), GET_ALL_CHUNK_SIZE)
+            ))
+            snapshots = [snapshot for chunk in chunk_results for snapshot in chunk]
+        except Exception as e:
+            logging.error(f"❌ 日次レポート用データの一括取得中にエラーが発生しました: {e}", exc_info=True)
+            return
+
+        # get_allは順序を保証しないため、親ドキュメント (ユーザーID) で対応付ける
+        rollups = {
+            snapshot.reference.parent.parent.id: snapshot.to_dict()
+            for snapshot in snapshots if snapshot.exists
+        }
+
+        # レポート生成時刻は全メンバー共通のため、ループの外で一度だけ整形する (時刻は集計対象日と同じnowを使う)
+        report_color = discord.Color.blue()
+        footer_text = f"レポート生成時刻: {now.strftime('%Y/%m/%d %H:%M:%S JST')}"
+
+        # 全メンバー（Bot以外）を対象にレポートを作成
+        embeds = []
+        for member in members:
+            user_data = summarize_daily_rollups([rollups[str(member.id)]]) if str(member.id) in rollups else None
             
             # データが存在しないか、合計時間が0の場合はスキップ
             if not user_data or user_data.get('total', 0) == 0:
@@ -417,27 +1017,50 @@ class StatusTrackerBot(commands.Bot):
             offline_time = user_data.get('offline_time_s', 0)
             total_sec = online_time + offline_time
             
-            total_formatted = format_time(total_sec)
-            online_formatted = format_time(online_time)
+            # Embedの本文はフィールドを追加せず、1つのdescriptionにまとめる
+            description = (
+                f"集計期間: **昨日（1日間）**\n"
+                f"📊 **合計活動時間: {format_time(total_sec)}**\n"
+                f"💻 オンライン活動時間: {format_time(online_time)}\n"
+                f"💤 オフライン時間: {format_time(offline_time)}"
+            )
             
+            # 日次レポートではメンバーごとのロール色計算 (O(roles)) を避け、固定色を使う
             embed = discord.Embed(
                 title=f"📅 {member.display_name} さんの日次レポート",
-                description=f"集計期間: **昨日（1日間）**\n📊 **合計活動時間: {total_formatted}**",
-                color=member.color if member.color != discord.Color.default() else discord.Color.blue()
+                description=description,
+                color=report_color
             )
             embed.set_thumbnail(url=member.display_avatar.url)
-
-            embed.add_field(name="💻 オンライン活動時間", value=online_formatted, inline=True)
-            embed.add_field(name="💤 オフライン時間", value=format_time(offline_time), inline=True)
             
-            embed.set_footer(text=f"レポート生成時刻: {datetime.now(tz_jst).strftime('%Y/%m/%d %H:%M:%S JST')}")
-
-            try:
-                await report_channel.send(embed=embed)
-                member_reports_sent += 1
-                await asyncio.sleep(0.5) # レートリミット回避のための一時停止
-            except Exception as e:
-                logging.error(f"❌ レポート送信失敗 (ユーザーID: {member.id}): {e}")
+            embed.set_footer(text=footer_text)
+            embeds.append((member, embed))
+
+        # Discordの1メッセージに含められる埋め込みの上限 (10個) ごとにまとめ、送信回数を減らす
+        # NOTE: 1メッセージの埋め込み全体の文字数上限 (6000字) に対し、日次レポートの埋め込みは1つ数百字のため10個でも収まる
+        messages = [embeds[start:start + EMBEDS_PER_MESSAGE] for start in range(0, len(embeds), EMBEDS_PER_MESSAGE)]
+
+        # チャンネルのレートリミット (5秒あたり5メッセージ) に合わせたレートリミッターで送信ペースを制御しつつ、レポートを並行して送信
+        send_bucket = TokenBucket(DAILY_REPORT_SEND_RATE, DAILY_REPORT_SEND_PER_SECONDS)
+
+        async def send_report(member_embeds):
+            member_ids = [member.id for member, _ in member_embeds]
+            for attempt in range(2):
+                async with send_bucket:
+                    try:
+                        await report_channel.send(embeds=[embed for _, embed in member_embeds])
+                        return len(member_embeds)
+                    except Exception as e:
+                        retry_after = get_retry_after(e)
+                        if retry_after is None or attempt == 1:
+                            logging.error(f"❌ レポート送信失敗 (ユーザーID: {member_ids}): {e}")
+                            return 0
+                # レートリミットに達した場合は、Discordが指定した時間だけ待機してから1回だけ再送する
+                logging.warning(f"⚠️ レートリミットに達しました。{retry_after:.2f}秒後に再送します (ユーザーID: {member_ids})")
+                await asyncio.sleep(retry_after)
+
+        results = await asyncio.gather(*(send_report(member_embeds) for member_embeds in messages))
+        member_reports_sent = sum(results)
 
         logging.info(f"--- ✅ 日次レポート処理完了。送信数: {member_reports_sent} ---")
         
@@ -450,105 +1073,134 @@ class StatusTrackerBot(commands.Bot):
 # -----------------
 # ヘルパー関数
 # -----------------
+@functools.lru_cache(maxsize=4096)
+def format_time_int(total_seconds_int: int) -> str:
+    """整数の秒数の時・分の部分を「X時間 Y分」形式に整形する (秒の部分は含まない。結果はキャッシュされる)"""
+    hours, remainder = divmod(total_seconds_int, 3600)
+    minutes = remainder // 60
+    
+    # 0の部分は省略する (リストを作らず、4通りの場合分けで1回だけ文字列を組み立てる)
+    if hours and minutes:
+        return f"{hours}時間 {minutes}分"
+    if hours:
+        return f"{hours}時間"
+    if minutes:
+        return f"{minutes}分"
+    return ""
+
 def format_time(seconds: float) -> str:
     """秒数を「X時間 Y分 Z.zs」形式に整形する"""
     if seconds < 0:
         return f"({format_time(abs(seconds))})"
         
     total_seconds_int = int(seconds)
+    hours_minutes = format_time_int(total_seconds_int)
     
-    hours, remainder = divmod(total_seconds_int, 3600)
-    minutes, seconds_int = divmod(remainder, 60)
-    
-    milliseconds = seconds - total_seconds_int
+    # 1分未満の端数 (小数点以下を含む)
+    remaining_seconds = total_seconds_int % 60 + (seconds - total_seconds_int)
     
-    parts = []
-    if hours > 0:
-        parts.append(f"{hours}時間")
-    if minutes > 0:
-        parts.append(f"{minutes}分")
-    
-    if seconds_int > 0 or milliseconds > 0 or not parts:
-        formatted_seconds = f"{seconds_int + milliseconds:.2f}秒"
-        parts.append(formatted_seconds)
-        
-    return " ".join(parts)
-
-def get_status_emoji(status):
-    """ステータス名に対応する絵文字と名前を返す"""
-    if status == 'online': return '🟢 オンライン'
-    if status == 'idle': return '🌙 退席中'
-    if status == 'dnd': return '🔴 取り込み中'
-    if status == 'offline': return '⚫ オフライン'
-    if status == 'invisible': return '⚫ オフライン' # ステルス表示を削除
-    return status.capitalize()
+    if not hours_minutes:
+        return f"{remaining_seconds:.2f}秒"
+    if remaining_seconds > 0:
+        return f"{hours_minutes} {remaining_seconds:.2f}秒"
+    return hours_minutes
+
+def get_retry_after(error: Exception):
+    """レートリミット (429) によるエラーであれば再送までの待機秒数を、それ以外のエラーであればNoneを返す"""
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after
+    if isinstance(error, discord.HTTPException) and error.status == 429:
+        return float(error.response.headers.get('Retry-After', 1.0))
+    return None
 
 def format_activity(activity: discord.Activity) -> str:
     """Discordのアクティビティ情報を整形する"""
-    if activity.type == discord.ActivityType.playing:
-        return f"Playing: {activity.name}"
-    elif activity.type == discord.ActivityType.streaming:
-        return f"Streaming: {activity.name} (URL: {activity.url})"
-    elif activity.type == discord.ActivityType.listening:
-        return f"Listening: {activity.name}"
-    elif activity.type == discord.ActivityType.watching:
-        return f"Watching: {activity.name}"
-    elif activity.type == discord.ActivityType.custom:
-        return f"Custom Status: {activity.name or 'N/A'}"
+    return format_activity_fields(activity.type, activity.name, getattr(activity, 'url', None))
+
+@functools.lru_cache(maxsize=1024)
+def format_activity_fields(activity_type: discord.ActivityType, name, url) -> str:
+    """アクティビティの種類・名前・URLを整形する (同じアクティビティは繰り返し現れるため、結果はキャッシュされる)"""
+    if activity_type == discord.ActivityType.playing:
+        return f"Playing: {name}"
+    elif activity_type == discord.ActivityType.streaming:
+        return f"Streaming: {name} (URL: {url})"
+    elif activity_type == discord.ActivityType.listening:
+        return f"Listening: {name}"
+    elif activity_type == discord.ActivityType.watching:
+        return f"Watching: {name}"
+    elif activity_type == discord.ActivityType.custom:
+        return f"Custom Status: {name or 'N/A'}"
     else:
-        return f"{activity.type.name.capitalize()}: {activity.name}"
+        return f"{activity_type.name.capitalize()}: {name}"
+
+@functools.lru_cache(maxsize=32)
+def report_days(today: str, days: int) -> tuple:
+    """集計対象の日付文字列 ('YYYY-MM-DD') を当日から過去に向かって days 日分返す
+
+    i=0が当日、i=1が昨日... となるため、集計範囲は「当日の days-1 日前」から当日まで。
+    キーに当日の日付を含むため、日付が変わると新しいエントリが作られる。
+    """
+    start = datetime.strptime(today, "%Y-%m-%d").date()
+    return tuple((start - timedelta(days=i)).isoformat() for i in range(days))
+
+def invalidate_report_cache(user_ids):
+    """指定したユーザーの /report 集計結果のキャッシュを破棄する"""
+    for user_id in user_ids:
+        _report_cache.pop(user_id, None)
+
+async def get_user_report_data(member: discord.Member, db, collection_ref, days=7):
+    """Firestoreの日別集計ドキュメントから指定した日数分の活動データを取得し集計する
+
+    同じユーザー・日数の集計結果はREPORT_CACHE_TTL_SECONDSの間キャッシュし、Firestoreを再度読まない。
+    """
+    today = datetime.now(tz_jst).date().isoformat()
+    cache_key = (today, days)
+    cached = _report_cache.get(member.id, {}).get(cache_key)
+    if cached is not None and monotonic() - cached[0] < REPORT_CACHE_TTL_SECONDS:
+        logging.debug(f"Report data cache hit for {member.id} ({days} days).")
+        return cached[1]
+
+    # 日別集計ドキュメントはIDが日付のため、対象期間の日数分の参照だけを作成して一括取得する
+    refs = [daily_ref(collection_ref, member.id, day) for day in report_days(today, days)]
 
-async def get_user_report_data(member: discord.Member, db, collection_path, days=7):
-    """Firestoreから指定した日数分の活動データを取得し集計する"""
-    doc_ref = db.collection(collection_path).document(str(member.id))
-    
     try:
-        # blocking I/O (Firestore get)をasyncio.to_threadで非同期に実行
-        doc = await asyncio.to_thread(doc_ref.get)
+        # blocking I/O (Firestore get_all)をFirestore専用スレッドプールで非同期に実行
+        docs = await run_firestore(lambda: [doc for doc in db.get_all(refs, field_paths=ROLLUP_FIELD_PATHS) if doc.exists])
     except Exception as e:
         # Firestoreアクセスエラーを捕捉
         logging.error(f"❌ Firestoreからのデータ取得中にエラーが発生しました (ユーザーID: {member.id}): {e}", exc_info=True)
         return None
 
-    if not doc.exists:
-        logging.debug(f"No document found for user {member.id}.")
-        return None
+    if not docs:
+        logging.debug(f"No daily rollup documents found for user {member.id}.")
+        user_data = None
+    else:
+        user_data = summarize_daily_rollups([doc.to_dict() for doc in docs])
+        logging.debug(f"Report data fetched for {member.id}: Total={user_data['total']:.2f}s")
 
-    data = doc.to_dict()
-    now = datetime.now(tz_jst)
-    # NOTE: 'invisible' は on_presence_update で 'offline' として記録されるため、集計は 'offline' に一本化される
-    statuses = ['online', 'idle', 'dnd', 'offline'] 
+    # 取得に成功した結果のみキャッシュする (エラー時は上でNoneを返しているため対象外)
+    if member.id not in _report_cache and len(_report_cache) >= REPORT_CACHE_MAX_USERS:
+        del _report_cache[next(iter(_report_cache))]
+    _report_cache.setdefault(member.id, {})[cache_key] = (monotonic(), user_data)
     
-    total_sec = 0
-    online_sec = 0
-    offline_sec = 0
-    user_data = {}
-
-    for status in statuses:
-        status_total_sec = 0
-        for i in range(days):
-            # i=0が当日、i=1が昨日... となるため、days=1の場合は昨日分のみ集計
-            # レポート対象は「現在時刻の days 日前」まで
-            target_date = (now - timedelta(days=i)).strftime("%Y-%m-%d")
-            field = f'{target_date}_{status}_seconds'
-            status_total_sec += data.get(field, 0)
-        
-        user_data[status] = status_total_sec
-        total_sec += status_total_sec
-        
-        if status in ['online', 'idle', 'dnd']:
-            online_sec += status_total_sec
-        elif status == 'offline':
-            offline_sec += status_total_sec # invisibleもofflineとして記録されている
-            
+    return user_data
+
+def summarize_daily_rollups(rollups: list) -> dict:
+    """日別集計ドキュメントのデータ (辞書) を合算し、レポート用の集計データを返す (I/Oは行わない)"""
+    # NOTE: 'invisible' は on_presence_update で 'offline' として記録されるため、集計は 'offline' に一本化される
+    # ステータスごとの合計は、各ステータスについて全日分を1回のsum()で合算する
+    user_data = {status: sum(data.get(status, 0) for data in rollups) for status in STATUS_NAMES}
+    # 各区分はステータスごとの合計から直接求める (引き算で求めると浮動小数点の誤差で、記録の無い区分が0にならない)
+    online_sec = sum(user_data[status] for status in STATUS_NAMES if status in ONLINE_STATUSES)
+    offline_sec = user_data['offline'] # invisibleもofflineとして記録されている
+    total_sec = online_sec + offline_sec
+
     # ユーザーが現在オンラインの場合、現在のステータスを一時的に加算して「現在までの合計」を表示する
     # ここでは、レポートの対象期間（過去 days 日間）に記録された時間のみを返します。
     user_data['total'] = total_sec
     user_data['online_time_s'] = online_sec
     user_data['offline_time_s'] = offline_sec
     
-    logging.debug(f"Report data fetched for {member.id}: Total={total_sec:.2f}s")
-    
     return user_data
 
 async def send_user_report_embed(interaction: discord.Interaction, member: discord.Member, user_data: dict, days: int):
@@ -567,50 +1219,34 @@ async def send_user_report_embed(interaction: discord.Interaction, member: disco
         await interaction.followup.send(f"⚠️ **{member.display_name}** さんの過去 **{days}** 日間の活動記録は見つかりませんでした。", ephemeral=True)
         return
 
-    total_formatted = format_time(total_sec)
-    online_formatted = format_time(online_time)
-    offline_formatted = format_time(offline_time)
+    # Embedの本文は1回の走査で行を組み立て、descriptionにまとめて設定する
+    lines = [
+        f"集計期間: 過去 **{days}** 日間",
+        f"📊 **合計活動時間: {format_time(total_sec)}**",
+        f"💻 オンライン活動時間: **{format_time(online_time)}**",
+        f"💤 オフライン時間: {format_time(offline_time)}",
+    ]
+    
+    # 'invisible' は 'offline' に含まれるため、STATUS_NAMESの4種類のみ表示する
+    status_lines = [
+        f"{STATUS_EMOJI[status]}: {format_time(user_data[status])}"
+        for status in STATUS_NAMES if user_data.get(status, 0) > 0
+    ]
+    
+    if status_lines:
+        lines.append("")
+        lines.append("**詳細内訳**")
+        lines.extend(status_lines)
     
+    # member.colorはロールを走査して求めるプロパティのため、1回だけ参照する
+    member_color = member.color
     embed = discord.Embed(
         title=f"⏳ {member.display_name} さんの活動時間レポート",
-        description=f"集計期間: 過去 **{days}** 日間",
-        color=member.color if member.color != discord.Color.default() else discord.Color.blue()
+        description="\n".join(lines),
+        color=member_color if member_color != discord.Color.default() else discord.Color.blue()
     )
     
     embed.set_thumbnail(url=member.display_avatar.url)
-
-    embed.add_field(
-        name="📊 合計活動時間",
-        value=f"**{total_formatted}**",
-        inline=False 
-    )
-    
-    embed.add_field(
-        name="💻 オンライン活動時間",
-        value=f"**{online_formatted}**",
-        inline=True
-    )
-    
-    embed.add_field(
-        name="💤 オフライン時間",
-        value=f"{offline_formatted}",
-        inline=True
-    )
-    
-    statuses = ['online', 'idle', 'dnd', 'offline'] # 'invisible' は含めない
-    status_field_value = []
-    
-    for status in statuses:
-        sec = user_data.get(f'{status}', 0)
-        if sec > 0:
-            status_field_value.append(f"{get_status_emoji(status)}: {format_time(sec)}")
-    
-    if status_field_value:
-        embed.add_field(
-            name="詳細内訳",
-            value="\n".join(status_field_value),
-            inline=False
-        )
     
     embed.set_footer(text=f"レポート生成時刻: {datetime.now(tz_jst).strftime('%Y/%m/%d %H:%M:%S JST')}")
     
@@ -621,10 +1257,18 @@ async def send_user_report_embed(interaction: discord.Interaction, member: disco
 # -----------------
 # スラッシュコマンド
 # -----------------
+# 必要なIntentsのみ有効にする (Intents.default()はメッセージ・リアクション・入力中・ボイスなども購読するため、none()から有効にする)
+# guilds: サーバー・チャンネルの情報 (レポートチャンネルの解決、チャンネル削除イベント)
+# members: メンバー一覧の取得・参加/退出イベント、presences: ステータス変更イベント
+# NOTE: スラッシュコマンドのインタラクションはIntentに関係なく受信する
+intents = discord.Intents.none()
+intents.guilds = True
+intents.members = True
+intents.presences = True
+
 bot = StatusTrackerBot(
     command_prefix='!', 
-    # Intentsの二重定義は修正済み
-    intents=discord.Intents.all() 
+    intents=intents
 )
 bot.remove_command('help') # デフォルトのhelpコマンドを削除
 
@@ -640,12 +1284,12 @@ async def report_command(interaction: discord.Interaction, member: discord.Membe
     
     target_member = member if member is not None else interaction.user
     
-    if db is None:
+    if bot.db is None:
         await interaction.followup.send("❌ データベースがまだ初期化されていません。しばらく待ってから再度お試しください。", ephemeral=True)
         return
 
     # データ取得
-    user_data = await get_user_report_data(target_member, db, bot.collection_path, days)
+    user_data = await get_user_report_data(target_member, bot.db, bot._get_collection_ref(), days)
     
     # レポート埋め込みメッセージの送信
     await send_user_report_embed(interaction, target_member, user_data, days)
@@ -661,7 +1305,7 @@ async def set_report_channel_command(interaction: discord.Interaction, channel:
     # すぐに応答できないため、Defer (応答待ち) 状態にする
     await interaction.response.defer(ephemeral=True, thinking=True)
 
-    if db is None:
+    if bot.db is None:
         await interaction.followup.send("❌ データベースがまだ初期化されていません。", ephemeral=True)
         return
 
@@ -669,13 +1313,9 @@ async def set_report_channel_command(interaction: discord.Interaction, channel:
     success = await bot._save_config(channel.id)
 
     if success:
-        # タスクがまだ開始されていない場合は開始
-        if not bot.daily_report.is_running():
-            bot.daily_report.start()
-            logging.info("日次レポートタスクを開始しました (コマンド実行による起動)。")
-        
+        # 日次レポートタスクは常に動いており、次回の実行時に新しいreport_channel_idを参照する
         await interaction.followup.send(
-            f"✅ 日次レポートの送信先を **{channel.mention}** に設定しました。\n毎日JST 00:00にレポートが送信されます。", 
+            f"✅ 日次レポートの送信先を **{channel.mention}** に設定しました。\n毎日JST {DAILY_REPORT_TIME_TEXT}にレポートが送信されます。", 
             ephemeral=True
         )
     else:
@@ -684,30 +1324,25 @@ async def set_report_channel_command(interaction: discord.Interaction, channel:
 # -----------------
 # WebサーバーとBotの実行
 # -----------------
-def run_bot():
-    """Botのメインループを実行する関数 (別スレッドで実行される)"""
-    
-    # Discordトークンは環境変数から取得
-    DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-    
-    if not DISCORD_BOT_TOKEN:
-        logging.error("❌ DISCORD_BOT_TOKEN環境変数が設定されていません。Botは起動できません。")
-        # Botの実行を中止
-        return
-
-    # Botを起動
+async def run_bot(token: str):
+    """Botのメインループを実行する (Webサーバーと同じイベントループ上のタスクとして実行される)"""
     try:
-        # Note: run()はブロッキング関数であり、Botが切断されるまで戻らない
+        # Note: bot.start()はBotが切断されるまで戻らない
         logging.info("Botクライアントを起動しています...")
         logging.info(f"🔑 Discordに接続を試行しています... (Process ID: {os.getpid()})")
         # ここでDiscordの接続ログが大量に出力されるはず
-        bot.run(DISCORD_BOT_TOKEN) 
+        await bot.start(token)
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         # Bot実行中の致命的なエラーを捕捉
         logging.error(f"❌ Bot実行中に致命的なエラーが発生しました: {e}", exc_info=True)
-    
-    # Bot.run()が予期せず終了した場合（ホスティング環境による強制終了や未捕捉の致命的エラーなど）
-    logging.critical("🛑 Botのメインループが予期せず終了しました。ホスティング環境による強制終了または未捕捉の致命的なエラーが原因の可能性があります。")
+        # Botのループが終了した場合（未捕捉の致命的エラーなど）
+        logging.critical("🛑 Botのメインループが予期せず終了しました。未捕捉の致命的なエラーが原因の可能性があります。")
+    finally:
+        # 未終了の場合はclose()でバッファ内のステータス時間を書き込んでから切断する
+        if not bot.is_closed():
+            await bot.close()
 
 
 def init_firestore():
@@ -722,7 +1357,7 @@ def init_firestore():
             logging.error("❌ __firebase_config環境変数が設定されていません。Firestoreを使用できません。")
             return
             
-        firebase_config = json.loads(firebase_config_str)
+        firebase_config = json_loads(firebase_config_str)
         logging.debug("✅ __firebase_config環境変数をロードし、JSONとして解析しました。")
         
         if not firebase_admin._apps: # 既に初期化されていないかチェック
@@ -734,7 +1369,7 @@ def init_firestore():
             if admin_key_json_str:
                 logging.info("Credential JSON found. Initializing Admin SDK with explicit key...")
                 # JSON文字列を解析し、資格情報として使用
-                cred = credentials.Certificate(json.loads(admin_key_json_str))
+                cred = credentials.Certificate(json_loads(admin_key_json_str))
                 firebase_admin.initialize_app(cred, {'projectId': firebase_config['projectId']})
             else:
                 # 警告: 外部環境ではこの方法が使えません。GCP/Firebase環境内で実行している場合のみ有効
@@ -749,32 +1384,60 @@ def init_firestore():
         
     except Exception as e:
         logging.error(f"❌ Firestore初期化中に致命的なエラーが発生しました: {e}", exc_info=True)
-        global bot_ready_status
-        bot_ready_status = False # DB初期化失敗時はBotを非稼働状態にする
         db = None # DBインスタンスをNoneに設定
 
-def start_bot_and_webserver():
-    """BotとFlask Webサーバーをそれぞれ別のスレッドで起動する"""
-    global bot_thread
+async def start_bot(app: web.Application):
+    """(Webサーバーの起動時に呼ばれる) Firestoreを初期化し、Botを同じイベントループ上のタスクとして起動する"""
+    global bot_task
 
-    # 1. Firestoreの初期化をメインスレッドで行う
+    # Discordトークンは環境変数から取得
+    DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
+    
+    if not DISCORD_BOT_TOKEN:
+        logging.error("❌ DISCORD_BOT_TOKEN環境変数が設定されていません。Botは起動できません。")
+        # Botの実行を中止 (ヘルスチェックには応答し続ける)
+        return
+
+    # 1. Firestoreの初期化 (起動時に一度だけ行う)
     init_firestore()
+    bot.db = db
 
-    # 2. Botの実行を別スレッドで開始
-    logging.info("Bot実行スレッドを開始します...")
-    bot_thread = Thread(target=run_bot, name="DiscordBotThread")
-    bot_thread.daemon = True # メインプロセス終了時にスレッドも終了
-    bot_thread.start()
-    logging.info(f"Bot実行スレッド: {bot_thread.name} (Thread ID: {bot_thread.ident}) が起動しました。メインプロセス ID: {os.getpid()}")
-
-    # 3. Flask Webサーバーの起動 (この関数を呼び出したプロセス/スレッドが担当)
-    # 外部からのアクセスを許可するために host='0.0.0.0' を指定
-    # Flaskはブロッキング関数であるため、この呼び出しがBot実行のメインループとなる
-    logging.info("Flask Webサーバーを起動します (host=0.0.0.0, port=8080)...")
+    # 2. Botの実行をタスクとして開始
+    bot_task = asyncio.create_task(run_bot(DISCORD_BOT_TOKEN), name="DiscordBot")
+    logging.info(f"Botタスクを開始しました。プロセス ID: {os.getpid()}")
+
+async def stop_bot(app: web.Application):
+    """(Webサーバーの終了時に呼ばれる) Botを正常に終了させ、バッファ内のステータス時間を書き込む"""
+    logging.info("🛑 Webサーバーを終了しています。Botを終了しています...")
+    if not bot.is_closed():
+        try:
+            await bot.close()
+        except Exception as e:
+            logging.error(f"❌ Botの終了処理中にエラーが発生しました: {e}", exc_info=True)
+    if bot_task is not None:
+        await bot_task
+    # Botの終了処理 (最後のフラッシュを含む) がすべて完了したので、Firestore専用スレッドプールを停止する
+    firestore_executor.shutdown(wait=False)
+
+# Webサーバー (aiohttp) のアプリケーション。Botの起動と終了をWebサーバーのライフサイクルに合わせる
+# NOTE: Botが二重に接続しないよう、必ず1プロセスで実行する (gunicornから起動する場合もワーカーは1つ)
+app = web.Application()
+app.add_routes(routes)
+app.on_startup.append(start_bot)
+app.on_cleanup.append(stop_bot)
+
+def start_bot_and_webserver():
+    """BotとWebサーバーを1つのイベントループで起動する"""
+    # run_appはSIGINT/SIGTERM (ホスティング環境による停止) を受けるとon_cleanupを呼んでから終了するため、
+    # バッファ内のデータを失わずに終了できる
+    port = int(os.environ.get('PORT', 8080))
+    logging.info(f"Webサーバーを起動します (host=0.0.0.0, port={port})...")
+    # BotとWebサーバーが共有するイベントループをuvloopで作成する (gunicornから起動する場合は GunicornUVLoopWebWorker を使う)
+    loop = uvloop.new_event_loop() if uvloop is not None else None
     try:
-        app.run(host='0.0.0.0', port=os.environ.get('PORT', 8080))
+        web.run_app(app, host='0.0.0.0', port=port, loop=loop)
     except Exception as e:
-        logging.critical(f"❌ Flask Webサーバー起動中に致命的なエラーが発生しました: {e}", exc_info=True)
+        logging.critical(f"❌ Webサーバー起動中に致命的なエラーが発生しました: {e}", exc_info=True)
 
 # スクリプトが直接実行された場合にBotとWebサーバーを起動
 if __name__ == '__main__':